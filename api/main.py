@@ -11,6 +11,9 @@ from fastapi.datastructures import QueryParams
 from github_webhooks import create_app
 from github_webhooks.schemas import WebhookHeaders
 
+# load .env before importing our libs, as they read settings (like PYTHON_ENV) at import
+dotenv.load_dotenv()
+
 from lib.auth import verify_apikey
 from lib.data import (
     get_project,
@@ -22,12 +25,9 @@ from lib.data import (
 )
 from lib.git import update_repo
 from lib.models import PingPayload, Project, Service, WorkflowJobPayload
-from lib.proxy import update_proxy, write_proxies
+from lib.proxy import pull_proxy, update_proxy, write_proxies
 from lib.upstream import check_upstream, update_upstream, write_upstreams
 
-dotenv.load_dotenv()
-
-
 api_token = os.environ["API_KEY"]
 app = create_app(secret_token=api_token)
 
@@ -37,9 +37,15 @@ def _after_config_change(project: str, service: str = None) -> None:
     info("Config change detected")
     # get_certs(project)
     write_proxies()
-    write_upstreams()
-    update_upstream(project, service, rollout=True)
-    update_proxy()
+    # pull the images of the freshly written proxy compose file while the upstreams are updated
+    pull = pull_proxy()
+    try:
+        write_upstreams()
+        update_upstream(project, service, rollout=True)
+    finally:
+        # always reap the pull, also when the above failed (update_proxy checks how it went)
+        pull.wait()
+    update_proxy(pull=pull)
     # reload_proxy()
 
 
@@ -16,7 +16,8 @@ if __name__ == "__main__":
     # if any argument is passed, we also do a rollout
     rollout = bool(sys.argv[1]) if len(sys.argv) > 1 else False
     # get_certs()
-    write_proxies()
+    # always write, as this is also used to apply changes to the code or templates
+    write_proxies(force=True)
     write_upstreams()
     update_upstreams(rollout)
     # reload_proxy()
@@ -15,5 +15,5 @@ load_dotenv()
 
 if __name__ == "__main__":
     validate_db()
-    write_proxies()
+    write_proxies(force=True)
     write_upstreams()
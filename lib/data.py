@@ -1,4 +1,7 @@
 import importlib
+import os
+from copy import deepcopy
+from functools import lru_cache
 from logging import debug, info
 from typing import Any, Callable, Dict, List, Union, cast
 
@@ -6,11 +9,23 @@ import yaml
 
 from lib.models import Env, Ingress, Plugin, PluginRegistry, Project, Service
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader  # type: ignore[assignment]
 
-def get_db() -> Dict[str, List[Dict[str, Any]] | Dict[str, Any]]:
-    """Get the db"""
+
+@lru_cache(maxsize=1)
+def _read_db(mtime_ns: int, size: int) -> Dict[str, List[Dict[str, Any]] | Dict[str, Any]]:
     with open("db.yml", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def get_db() -> Dict[str, List[Dict[str, Any]] | Dict[str, Any]]:
+    """Get the db (only parsed again when db.yml changed on disk)"""
+    stat = os.stat("db.yml")
+    # hand out a copy so callers can't change the cached db
+    return deepcopy(_read_db(stat.st_mtime_ns, stat.st_size))
 
 
 def write_db(partial: Dict[str, List[Dict[str, Any]] | Dict[str, Any]]) -> None:
@@ -21,6 +36,7 @@ def write_db(partial: Dict[str, List[Dict[str, Any]] | Dict[str, Any]]) -> None:
     db = {**db, **partial}
     with open("db.yml", "w", encoding="utf-8") as f:
         yaml.dump(db, f)
+    _read_db.cache_clear()
 
 
 def get_plugin_model(name: str) -> type[Plugin]:
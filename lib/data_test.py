@@ -2,12 +2,15 @@
 import os
 import sys
 import unittest
+from typing import Any, Dict, cast
 from unittest import mock
 from unittest.mock import Mock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.data import (
+    _read_db,
+    get_db,
     get_project,
     get_projects,
     get_service,
@@ -17,21 +20,22 @@ from lib.data import (
     write_projects,
 )
 from lib.models import Env, Ingress, Project, Service
-from lib.test_stubs import test_db, test_projects
+from lib.test_stubs import get_test_db, test_projects
 
 
 class TestData(unittest.TestCase):
 
-    @mock.patch("lib.data.get_db", return_value=test_db.copy())
+    @mock.patch("lib.data.get_db")
     @mock.patch(
         "lib.data.yaml",
         return_value={"dump": mock.Mock()},
     )
     @mock.patch("builtins.open", new_callable=mock.mock_open)
-    def test_write_db(self, mock_open: Mock, mock_yaml: Mock, _: Mock) -> None:
+    def test_write_db(self, mock_open: Mock, mock_yaml: Mock, mock_get_db: Mock) -> None:
+        mock_get_db.return_value = get_test_db().copy()
 
         # Call the function under test
-        write_db({"projects": test_db["projects"]})
+        write_db({"projects": get_test_db()["projects"]})
 
         mock_open.assert_called_once_with("db.yml", "w", encoding="utf-8")
 
@@ -39,12 +43,32 @@ class TestData(unittest.TestCase):
         mock_yaml.dump.assert_called_once_with(
             {
                 "versions": {"traefik": "v3", "crowdsec": "v1.6.0"},
-                "plugins": test_db["plugins"],
-                "projects": test_db["projects"],
+                "plugins": get_test_db()["plugins"],
+                "projects": get_test_db()["projects"],
             },
             mock_open(),
         )
 
+    @mock.patch("os.stat")
+    @mock.patch("builtins.open", new_callable=mock.mock_open, read_data="versions:\n  traefik: v3\n")
+    def test_get_db_cached(self, mock_open: Mock, mock_stat: Mock) -> None:
+        _read_db.cache_clear()
+        self.addCleanup(_read_db.cache_clear)
+        mock_stat.return_value = mock.Mock(st_mtime_ns=1, st_size=20)
+
+        # Call the function under test
+        db = get_db()
+        cast(Dict[str, Any], db["versions"])["traefik"] = "changed"
+
+        # Assert that the unchanged file is parsed only once, and callers get their own copy
+        self.assertEqual(get_db(), {"versions": {"traefik": "v3"}})
+        mock_open.assert_called_once_with("db.yml", encoding="utf-8")
+
+        # Assert that a changed file is parsed again
+        mock_stat.return_value = mock.Mock(st_mtime_ns=2, st_size=20)
+        get_db()
+        self.assertEqual(mock_open.call_count, 2)
+
     @mock.patch("lib.data.write_db")
     def test_write_projects(self, mock_write_db: Mock) -> None:
 
@@ -55,11 +79,9 @@ class TestData(unittest.TestCase):
         mock_write_db.assert_called_once()
 
     # Get projects with filter
-    @mock.patch(
-        "lib.data.get_db",
-        return_value=test_db.copy(),
-    )
-    def test_get_projects_with_filter(self, _: Mock) -> None:
+    @mock.patch("lib.data.get_db")
+    def test_get_projects_with_filter(self, mock_get_db: Mock) -> None:
+        mock_get_db.return_value = get_test_db().copy()
 
         # Call the function under test
         result = get_projects(lambda p, s: p.name == "whoami" and s.ingress)[0]
@@ -76,12 +98,10 @@ class TestData(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
     # Get all projects with no filter
-    @mock.patch(
-        "lib.data.get_db",
-        return_value=test_db.copy(),
-    )
+    @mock.patch("lib.data.get_db")
     def test_get_projects_no_filter(self, mock_get_db: Mock) -> None:
         self.maxDiff = None
+        mock_get_db.return_value = get_test_db().copy()
 
         # Call the function under test
         get_projects()
@@ -15,7 +15,8 @@ def update_repo() -> None:
     if os.environ["PYTHON_ENV"] == "production":
         run_command("git fetch origin main".split(" "), cwd=".")
         run_command("git reset --hard origin/main".split(" "), cwd=".")
-    write_proxies()
+    # the reset may have changed the code or templates, so always write
+    write_proxies(force=True)
     write_upstreams()
     update_upstreams()
     # reload_proxy()
@@ -1,15 +1,141 @@
+import hashlib
+import inspect
+import json
 import os
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from functools import cache
 from logging import info
-from typing import Callable, Dict, List
+from typing import IO, Any, Callable, Dict, Iterator, List, Tuple
 
 from dotenv import load_dotenv
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, Template
+
+from lib import data, models
+from lib.data import (
+    get_db,
+    get_plugin_registry,
+    get_project,
+    get_projects,
+    get_versions,
+)
+from lib.models import Plugin, PluginRegistry, Protocol, ProxyProtocol, Router
+from lib.utils import run_command, start_command, wait_commands
+
+# compiled templates are cached, and recompiled when their file changed (e.g. after update_repo pulled new ones)
+_ENV = Environment(loader=FileSystemLoader("proxy/tpl"))
+_ENV.globals.update({"Protocol": Protocol, "ProxyProtocol": ProxyProtocol, "Router": Router})
+
+
+def _precompile_templates() -> None:
+    """Compile all templates up front so the first write_proxies() doesn't pay for parsing them"""
+    for name in _ENV.list_templates(extensions=["j2"]):
+        _ENV.get_template(name)
+
+
+if os.environ.get("PYTHON_ENV") == "production":
+    _precompile_templates()
+
+
+# settings from the env that end up in the rendered configs
+_RENDER_ENV = (
+    "DOMAIN_SUFFIX",
+    "LETSENCRYPT_EMAIL",
+    "LETSENCRYPT_STAGING",
+    "TRAEFIK_ADMIN",
+    "TRAEFIK_DOMAIN",
+    "TRUSTED_IPS_CIDRS",
+)
+_HASH_FILE = "proxy/.state/last_hash"
+# everything write_proxies() writes
+_OUTPUTS = (
+    "proxy/docker-compose.yml",
+    "proxy/nginx/map/internal.conf",
+    "proxy/nginx/map/passthrough.conf",
+    "proxy/nginx/map/terminate.conf",
+    "proxy/nginx/proxy.conf",
+    "proxy/nginx/terminate.conf",
+    "proxy/traefik/dynamic/routers-http.yml",
+    "proxy/traefik/dynamic/routers-tcp.yml",
+    "proxy/traefik/dynamic/routers-udp.yml",
+    "proxy/traefik/traefik.yml",
+)
+# the code the configs are rendered with, so an upgrade of it also invalidates the last hash
+_CODE_HASH = hashlib.blake2b(
+    "".join(inspect.getsource(m) for m in (sys.modules[__name__], data, models)).encode()
+).digest()
+
+
+@cache
+def _env() -> None:
+    """Load .env once, on first use instead of at import"""
+    load_dotenv()
+
+
+@contextmanager
+def _atomic_open(path: str) -> Iterator[IO[bytes]]:
+    """Open a temp file that is moved into place when done, so readers never see a partial config"""
+    # a unique temp file per write, so concurrent writes of the same config don't trip over each other
+    tmp = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+        delete=False,
+        buffering=128 * 1024,
+    )
+    try:
+        with tmp:
+            yield tmp
+        # temp files are created private, but the proxy containers need to read the configs
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, path)
+    except BaseException:
+        # don't leave half written temp files next to the configs
+        os.unlink(tmp.name)
+        raise
+
+
+def _atomic_write(path: str, tpl: Template, **kwargs: Any) -> None:
+    with _atomic_open(path) as f:
+        tpl.stream(**kwargs).dump(f, encoding="utf-8")
+
+
+def _render_map(map: Dict[str, str]) -> str:
+    """Render an nginx map the way map.conf.j2 does, without going through Jinja"""
+    return "".join(f"{domain} {service};\n" for domain, service in map.items())
+
+
+def _inputs_hash() -> str:
+    """Hash everything the proxy configs are rendered from: the db, the relevant env, the templates and the code"""
+    h = hashlib.blake2b(_CODE_HASH)
+    h.update(json.dumps(get_db(), sort_keys=True, default=str).encode())
+    h.update(json.dumps({k: os.environ.get(k) for k in _RENDER_ENV}).encode())
+    # read the templates through the loader the templates are rendered with
+    # (auto_reload recompiles any template whose source changed since it was cached)
+    for name in sorted(_ENV.list_templates(extensions=["j2"])):
+        source, _, _ = _ENV.loader.get_source(_ENV, name)
+        h.update(source.encode())
+    return h.hexdigest()
+
 
-from lib.data import get_plugin_registry, get_project, get_projects, get_versions
-from lib.models import Plugin, Protocol, ProxyProtocol, Router
-from lib.utils import run_command
+def _outputs_exist() -> bool:
+    return all(os.path.exists(path) for path in _OUTPUTS)
 
-load_dotenv()
+
+def _last_hash() -> str | None:
+    try:
+        with open(_HASH_FILE, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _save_hash(inputs_hash: str) -> None:
+    os.makedirs(os.path.dirname(_HASH_FILE), exist_ok=True)
+    with open(_HASH_FILE, "w", encoding="utf-8") as f:
+        f.write(inputs_hash)
 
 
 def get_domains(filter: Callable[[Plugin], bool] = None) -> List[str]:
@@ -32,123 +158,92 @@ def get_domains(filter: Callable[[Plugin], bool] = None) -> List[str]:
     return list(domains)
 
 
-def get_internal_map() -> Dict[str, str]:
-    domains = get_domains()
-    return {d: "terminate:8443" for d in domains}
+def get_internal_map(domains: List[str] = None) -> Dict[str, str]:
+    if domains is None:
+        domains = get_domains()
+    return dict.fromkeys(domains, "terminate:8443")
 
 
-def get_terminate_map() -> Dict[str, str]:
-    projects = get_projects(filter=lambda _, _2, i: not i.passthrough)
-    map = {}
+def get_ingress_maps() -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Get the terminate and passthrough maps in one pass over all ingress"""
+    projects = get_projects()
+    terminate_map = {}
+    passthrough_map = {}
     for p in projects:
         for s in p.services:
             prefix = f"{p.name}-" if s.image else ""
             for i in s.ingress:
-                map[i.domain] = f"{prefix}{s.host}:{i.port}"
-    return map
+                if i.passthrough:
+                    passthrough_map[i.domain] = f"{s.host}:{i.port if 'port' in i else 8080}"
+                else:
+                    terminate_map[i.domain] = f"{prefix}{s.host}:{i.port}"
+    return terminate_map, passthrough_map
 
 
-def get_passthrough_map() -> Dict[str, str]:
-    projects = get_projects(filter=lambda _, _2, i: i.passthrough)
-    map = {}
-    for p in projects:
-        for s in p.services:
-            for i in s.ingress:
-                map[i.domain] = f"{s.host}:{i.port if 'port' in i else 8080}"
-    return map
-
-
-def write_maps() -> None:
-    internal_map = get_internal_map()
-    passthrough_map = get_passthrough_map()
-    terminate_map = get_terminate_map()
-    with open("proxy/tpl/map.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    internal = tpl.render(map=internal_map)
-    passthrough = tpl.render(map=passthrough_map)
-    terminate = tpl.render(map=terminate_map)
-    with open("proxy/nginx/map/internal.conf", "w", encoding="utf-8") as f:
-        f.write(internal)
-    with open("proxy/nginx/map/passthrough.conf", "w", encoding="utf-8") as f:
-        f.write(passthrough)
-    with open("proxy/nginx/map/terminate.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+def write_maps(domains: List[str] = None) -> None:
+    internal_map = get_internal_map(domains)
+    terminate_map, passthrough_map = get_ingress_maps()
+    for name, map in [("internal", internal_map), ("passthrough", passthrough_map), ("terminate", terminate_map)]:
+        with _atomic_open(f"proxy/nginx/map/{name}.conf") as f:
+            f.write(_render_map(map).encode("utf-8"))
 
 
 def write_proxy() -> None:
     project = get_project("home-assistant", throw=False)
-    with open("proxy/tpl/proxy.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    terminate = tpl.render(project=project)
-    with open("proxy/nginx/proxy.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+    tpl = _ENV.get_template("proxy.conf.j2")
+    _atomic_write("proxy/nginx/proxy.conf", tpl, project=project)
 
 
-def write_terminate() -> None:
-    domains = get_domains()
-    with open("proxy/tpl/terminate.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    terminate = tpl.render(domains=domains)
-    with open("proxy/nginx/terminate.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+def write_terminate(domains: List[str] = None) -> None:
+    if domains is None:
+        domains = get_domains()
+    tpl = _ENV.get_template("terminate.conf.j2")
+    _atomic_write("proxy/nginx/terminate.conf", tpl, domains=domains)
 
 
-def write_routers() -> None:
+def write_routers(plugin_registry: PluginRegistry = None) -> None:
+    _env()
+    if plugin_registry is None:
+        plugin_registry = get_plugin_registry()
     # we only get the stuff with passthrough or hostport + domain as the port 80/443 containers
     # have labels themselves and will be picked up dynamically
     projects_http = get_projects(
         filter=lambda _, s, i: i.router == Router.http
         and (i.passthrough or not s.image or (i.hostport and (i.domain or i.tls)))
     )
-    with open("proxy/tpl/routers-http.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_http = Template(t)
+    tpl_routers_http = _ENV.get_template("routers-http.yml.j2")
     domain = os.environ.get("TRAEFIK_DOMAIN")
-    routers_http = tpl_routers_http.render(
+    _atomic_write(
+        "proxy/traefik/dynamic/routers-http.yml",
+        tpl_routers_http,
         domain_suffix=os.environ.get("DOMAIN_SUFFIX"),
-        plugin_registry=get_plugin_registry(),
+        plugin_registry=plugin_registry,
         projects=projects_http,
         traefik_admin=os.environ.get("TRAEFIK_ADMIN"),
         traefik_rule=f"Host(`{domain}`)",
         trusted_ips_cidrs=os.environ.get("TRUSTED_IPS_CIDRS").split(","),
     )
-    with open("proxy/traefik/dynamic/routers-http.yml", "w", encoding="utf-8") as f:
-        f.write(routers_http)
     projects_tcp = get_projects(
         filter=lambda _, s, i: i.router == Router.tcp and (i.passthrough or not s.image or i.hostport)
     )
-    with open("proxy/tpl/routers-tcp.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_tcp = Template(t)
-    tpl_routers_tcp.globals["ProxyProtocol"] = ProxyProtocol
-    routers_tcp = tpl_routers_tcp.render(
-        projects=projects_tcp,
-    )
-    with open("proxy/traefik/dynamic/routers-tcp.yml", "w", encoding="utf-8") as f:
-        f.write(routers_tcp)
+    tpl_routers_tcp = _ENV.get_template("routers-tcp.yml.j2")
+    _atomic_write("proxy/traefik/dynamic/routers-tcp.yml", tpl_routers_tcp, projects=projects_tcp)
     projects_udp = get_projects(filter=lambda _, _2, i: i.router == Router.udp)
-    with open("proxy/tpl/routers-udp.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_udp = Template(t)
-    routers_udp = tpl_routers_udp.render(projects=projects_udp)
-    with open("proxy/traefik/dynamic/routers-udp.yml", "w", encoding="utf-8") as f:
-        f.write(routers_udp)
-
-
-def write_config() -> None:
-    with open("proxy/tpl/traefik.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_config_http = Template(t)
-    tpl_config_http.globals["Protocol"] = Protocol
-    tpl_config_http.globals["Router"] = Router
+    tpl_routers_udp = _ENV.get_template("routers-udp.yml.j2")
+    _atomic_write("proxy/traefik/dynamic/routers-udp.yml", tpl_routers_udp, projects=projects_udp)
+
+
+def write_config(plugin_registry: PluginRegistry = None) -> None:
+    _env()
+    if plugin_registry is None:
+        plugin_registry = get_plugin_registry()
+    tpl_config_http = _ENV.get_template("traefik.yml.j2")
     trusted_ips_cidrs = os.environ.get("TRUSTED_IPS_CIDRS").split(",")
     projects_hostport = get_projects(filter=lambda _, _2, i: i.hostport)
-    plugin_registry = get_plugin_registry()
     has_plugins = any(plugin.enabled for _, plugin in plugin_registry)
-    config_http = tpl_config_http.render(
+    _atomic_write(
+        "proxy/traefik/traefik.yml",
+        tpl_config_http,
         has_plugins=has_plugins,
         le_email=os.environ.get("LETSENCRYPT_EMAIL"),
         le_staging=bool(os.environ.get("LETSENCRYPT_STAGING")),
@@ -156,53 +251,78 @@ def write_config() -> None:
         projects=projects_hostport,
         trusted_ips_cidrs=trusted_ips_cidrs,
     )
-    with open("proxy/traefik/traefik.yml", "w", encoding="utf-8") as f:
-        f.write(config_http)
 
 
-def write_compose() -> None:
-    plugin_registry = get_plugin_registry()
+def write_compose(plugin_registry: PluginRegistry = None) -> None:
+    if plugin_registry is None:
+        plugin_registry = get_plugin_registry()
     versions = get_versions()
-    with open("proxy/tpl/docker-compose.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_compose = Template(t)
-    tpl_compose.globals["Protocol"] = Protocol
+    tpl_compose = _ENV.get_template("docker-compose.yml.j2")
     projects_hostport = get_projects(filter=lambda _, _2, i: bool(i.hostport))
-    compose = tpl_compose.render(versions=versions, projects=projects_hostport, plugin_registry=plugin_registry)
-    with open("proxy/docker-compose.yml", "w", encoding="utf-8") as f:
-        f.write(compose)
+    _atomic_write(
+        "proxy/docker-compose.yml",
+        tpl_compose,
+        versions=versions,
+        projects=projects_hostport,
+        plugin_registry=plugin_registry,
+    )
 
 
-def write_proxies() -> None:
-    write_maps()
+def write_proxies(force: bool = False) -> bool:
+    """Write all proxy configs. Returns False when nothing changed since the last write (unless forced),
+    so callers can skip reloading the proxy."""
+    _env()
+    inputs_hash = _inputs_hash()
+    if not force and _last_hash() == inputs_hash and _outputs_exist():
+        info("Proxy config inputs unchanged, not writing proxy configs")
+        return False
+    # look these up once for the whole run instead of in every writer that needs them
+    domains = get_domains()
+    plugin_registry = get_plugin_registry()
+    write_maps(domains)
     write_proxy()
-    write_terminate()
-    write_routers()
-    write_config()
-    write_compose()
+    write_terminate(domains)
+    write_routers(plugin_registry)
+    write_config(plugin_registry)
+    write_compose(plugin_registry)
+    _save_hash(inputs_hash)
+    return True
+
+
+def pull_proxy() -> subprocess.Popen[bytes]:
+    """Start pulling the proxy images in the background, to be handed to update_proxy"""
+    info("Pulling proxy images")
+    return start_command(["docker", "compose", "pull"], cwd="proxy")
 
 
 def update_proxy(
     service: str = None,
+    pull: subprocess.Popen[bytes] = None,
 ) -> None:
-    """Reload service(s) in the docker compose config for the proxy"""
+    """Reload service(s) in the docker compose config for the proxy.
+    Pass the process returned by pull_proxy() to wait on an already running pull instead of pulling again."""
+    _env()
     info(f"Updating proxy {service}")
-    run_command(["docker", "compose", "pull"], cwd="proxy")
+    if pull is None:
+        run_command(["docker", "compose", "pull"], cwd="proxy")
+    elif pull.wait() != 0:
+        raise subprocess.CalledProcessError(pull.returncode, pull.args)
     run_command(["docker", "compose", "up", "-d"], cwd="proxy")
     # rollout_proxy(service)
 
 
 def reload_proxy(service: str = None) -> None:
     info("Reloading proxy")
-    # Execute docker compose command to reload nginx for both 'proxy' and 'terminate' services
-    for s in [service] if service else ["proxy", "terminate"]:
-        run_command(
-            ["docker", "compose", "exec", s, "nginx", "-s", "reload"],
-            cwd="proxy",
-        )
+    services = [service] if service else ["proxy", "terminate"]
+    # Execute docker compose command to reload nginx for both 'proxy' and 'terminate' services,
+    # which run in separate containers so can be reloaded at the same time
+    wait_commands(
+        [start_command(["docker", "compose", "exec", s, "nginx", "-s", "reload"], cwd="proxy") for s in services]
+    )
 
 
 def rollout_proxy(service: str = None) -> None:
     info(f"Rolling out proxy {service}")
-    for s in [service] if service else ["proxy", "terminate"]:
-        run_command(["docker", "rollout", s], cwd="proxy")
+    services = [service] if service else ["proxy", "terminate"]
+    # docker rollout only takes one service, so roll them out side by side
+    wait_commands([start_command(["docker", "rollout", s], cwd="proxy") for s in services])
@@ -0,0 +1,170 @@
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import TestCase, mock
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.proxy import _ENV, _atomic_open, _render_map, update_proxy, write_proxies
+
+_writers = ["write_maps", "write_proxy", "write_terminate", "write_routers", "write_config", "write_compose"]
+
+
+@mock.patch("lib.proxy._save_hash")
+@mock.patch("lib.proxy.get_plugin_registry")
+@mock.patch("lib.proxy.get_domains", return_value=["example.com"])
+@mock.patch("lib.proxy._inputs_hash", return_value="abc")
+class TestWriteProxies(TestCase):
+
+    def setUp(self) -> None:
+        self.writers = {}
+        for name in _writers:
+            patcher = mock.patch(f"lib.proxy.{name}")
+            self.writers[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("lib.proxy._outputs_exist", return_value=True)
+        self.mock_outputs_exist = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Nothing is written when the inputs are the same as last time
+    @mock.patch("lib.proxy._last_hash", return_value="abc")
+    def test_write_proxies_unchanged(self, _: Mock, _2: Mock, _3: Mock, _4: Mock, mock_save_hash: Mock) -> None:
+
+        # Call the function under test
+        result = write_proxies()
+
+        self.assertFalse(result)
+        for writer in self.writers.values():
+            writer.assert_not_called()
+        mock_save_hash.assert_not_called()
+
+    # All configs are written and the new hash saved when the inputs changed
+    @mock.patch("lib.proxy._last_hash", return_value="old")
+    def test_write_proxies_changed(
+        self, _: Mock, _2: Mock, _3: Mock, mock_get_plugin_registry: Mock, mock_save_hash: Mock
+    ) -> None:
+
+        # Call the function under test
+        result = write_proxies()
+
+        self.assertTrue(result)
+        for writer in self.writers.values():
+            writer.assert_called_once()
+        self.writers["write_maps"].assert_called_once_with(["example.com"])
+        self.writers["write_terminate"].assert_called_once_with(["example.com"])
+        # the plugin registry is looked up once and shared by the writers that need it
+        mock_get_plugin_registry.assert_called_once()
+        for name in ["write_routers", "write_config", "write_compose"]:
+            self.writers[name].assert_called_once_with(mock_get_plugin_registry.return_value)
+        mock_save_hash.assert_called_once_with("abc")
+
+    # All configs are written when one of them went missing, even when the inputs are unchanged
+    @mock.patch("lib.proxy._last_hash", return_value="abc")
+    def test_write_proxies_output_missing(self, _: Mock, _2: Mock, _3: Mock, _4: Mock, mock_save_hash: Mock) -> None:
+        self.mock_outputs_exist.return_value = False
+
+        # Call the function under test
+        result = write_proxies()
+
+        self.assertTrue(result)
+        for writer in self.writers.values():
+            writer.assert_called_once()
+        mock_save_hash.assert_called_once_with("abc")
+
+    # Forcing writes everything, even when nothing changed
+    @mock.patch("lib.proxy._last_hash", return_value="abc")
+    def test_write_proxies_forced(self, _: Mock, _2: Mock, _3: Mock, _4: Mock, mock_save_hash: Mock) -> None:
+
+        # Call the function under test
+        result = write_proxies(force=True)
+
+        self.assertTrue(result)
+        for writer in self.writers.values():
+            writer.assert_called_once()
+        mock_save_hash.assert_called_once_with("abc")
+
+
+class TestUpdateProxy(TestCase):
+
+    # Waits on the running pull instead of pulling again, then brings the proxy up
+    @mock.patch("lib.proxy.run_command")
+    def test_update_proxy_with_pull(self, mock_run_command: Mock) -> None:
+        pull = Mock(returncode=0, args=["docker", "compose", "pull"])
+        pull.wait.return_value = 0
+
+        # Call the function under test
+        update_proxy(pull=pull)
+
+        pull.wait.assert_called_once()
+        mock_run_command.assert_called_once_with(["docker", "compose", "up", "-d"], cwd="proxy")
+
+    # A failed pull is raised, and the proxy is not brought up
+    @mock.patch("lib.proxy.run_command")
+    def test_update_proxy_with_failed_pull(self, mock_run_command: Mock) -> None:
+        pull = Mock(returncode=1, args=["docker", "compose", "pull"])
+        pull.wait.return_value = 1
+
+        # Call the function under test
+        with self.assertRaises(subprocess.CalledProcessError):
+            update_proxy(pull=pull)
+
+        mock_run_command.assert_not_called()
+
+
+class TestRenderMap(TestCase):
+
+    # The specialized renderer gives the same output as map.conf.j2
+    def test_render_map_matches_template(self) -> None:
+        tpl = _ENV.get_template("map.conf.j2")
+        for map in [
+            {},
+            {"example.com": "terminate:8443"},
+            {"whoami.example.com": "whoami-web:8080", "itsup.example.com": "172.17.0.1:8888"},
+        ]:
+            self.assertEqual(_render_map(map), tpl.render(map=map))
+
+
+class TestAtomicOpen(TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "proxy.conf")
+
+    # Concurrent writes of the same file each use their own temp file
+    def test_atomic_open_concurrent(self) -> None:
+
+        # Call the function under test
+        with _atomic_open(self.path) as f1:
+            with _atomic_open(self.path) as f2:
+                f2.write(b"second")
+            f1.write(b"first")
+
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"first")
+        self.assertEqual(os.listdir(self.dir), ["proxy.conf"])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+
+    # A failing write leaves the old file in place and no temp file behind
+    def test_atomic_open_failure(self) -> None:
+        with open(self.path, "wb") as f:
+            f.write(b"old")
+
+        # Call the function under test
+        with self.assertRaises(ValueError):
+            with _atomic_open(self.path) as f:
+                f.write(b"partial")
+                raise ValueError("render failed")
+
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"old")
+        self.assertEqual(os.listdir(self.dir), ["proxy.conf"])
+
+
+if __name__ == "__main__":
+    unittest.main()
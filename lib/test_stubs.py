@@ -1,9 +1,18 @@
+from functools import cache
+from typing import Any, Dict, List
+
 import yaml
 
+from lib.data import SafeLoader
 from lib.models import Ingress, Plugin, Project, Router, Service
 
-with open("db.yml.sample", encoding="utf-8") as f:
-    test_db = yaml.safe_load(f)
+
+@cache
+def get_test_db() -> Dict[str, List[Dict[str, Any]] | Dict[str, Any]]:
+    """Get the sample db, parsed once and only when a test needs it"""
+    with open("db.yml.sample", encoding="utf-8") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
 
 test_plugins = {
     "crowdsec": Plugin(
@@ -1,59 +1,63 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from logging import info
 
-from dotenv import load_dotenv
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader
 
 from lib.data import get_project, get_projects, get_service
 from lib.models import Project, Protocol, Router
 from lib.utils import run_command
 
-load_dotenv()
+# compiled templates are cached, and recompiled when their file changed (e.g. after update_repo pulled new ones)
+_ENV = Environment(loader=FileSystemLoader("tpl"))
+_ENV.globals.update({"Protocol": Protocol, "Router": Router})
 
 
 def write_upstream(project: Project) -> None:
-    with open("tpl/docker-compose.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    tpl.globals["Protocol"] = Protocol
-    tpl.globals["Router"] = Router
-    tpl.globals["isinstance"] = isinstance
-    tpl.globals["len"] = len
-    tpl.globals["list"] = list
-    tpl.globals["str"] = str
-    content = tpl.render(project=project)
+    tpl = _ENV.get_template("docker-compose.yml.j2")
+    os.makedirs(f"upstream/{project.name}", exist_ok=True)
     with open(f"upstream/{project.name}/docker-compose.yml", "w", encoding="utf-8") as f:
-        f.write(content)
+        tpl.stream(project=project).dump(f)
     if project.env:
-        env_content = "\n".join([f"{k}={v}" for k, v in project.env])
         with open(f"upstream/{project.name}/.env", "w", encoding="utf-8") as f:
-            f.write(env_content)
+            f.writelines(f"{k}={v}\n" for k, v in project.env)
 
 
 def write_upstream_volume_folders(project: Project) -> None:
+    prefix = f"upstream/{project.name}"
+    paths = set()
     for s in project.services:
         for path in s.volumes:
-            # if occurences of colon > 1 then:
-            if path.count(":") > 1:
-                # strip parts such as :ro and :rw from the end first
-                path = path.rsplit(":", 1)[0]
-            # if path still contains colon, and starts with '/' or '../',
+            # if path contains a colon and starts with '/', or starts with '../',
             # then we know its an existing host path, so skip
             if ":" in path and path.startswith("/") or path.startswith("../"):
                 continue
-            # check if it still has a colon, if so, split it and get the first part, else use the whole path
-            path = path.split(":", 1)[0] if ":" in path else path
+            # use the part before the first colon (this also drops suffixes such as :ro and :rw)
+            path = path.partition(":")[0]
             # remove leading dot or add slash if
             path = path[1:] if path.startswith(".") else "/" + path if not path.startswith("/") else path
-            os.makedirs(f"upstream/{project.name}{path}", exist_ok=True)
+            paths.add(prefix + path)
+    # only create the deepest folders, as makedirs creates their parents along the way
+    # (sorting by path segments puts every folder right before its subfolders)
+    paths_sorted = sorted(paths, key=lambda p: p.split("/"))
+    for path, next_path in zip(paths_sorted, paths_sorted[1:] + [""]):
+        if not next_path.startswith(f"{path}/"):
+            os.makedirs(path, exist_ok=True)
+
+
+def _write_project(project: Project) -> None:
+    write_upstream(project)
+    write_upstream_volume_folders(project)
 
 
 def write_upstreams() -> None:
     projects = get_projects(filter=lambda p, s: p.enabled and s.image)
-    for p in projects:
-        os.makedirs(f"upstream/{p.name}", exist_ok=True)
-        write_upstream(p)
-        write_upstream_volume_folders(p)
+    if not projects:
+        return
+    # projects are written to their own folders, so their (mostly i/o) work can overlap
+    with ThreadPoolExecutor(max_workers=min(32, len(projects))) as executor:
+        # consume the results so exceptions from the workers are raised here
+        list(executor.map(_write_project, projects))
 
 
 def check_upstream(project: str, service: str = None) -> None:
@@ -91,10 +95,12 @@ def update_upstream(
 
 
 def update_upstreams(rollout: bool = False) -> None:
-    for upstream_dir in [f.path for f in os.scandir("upstream") if f.is_dir()]:
-        # get last item from path:
-        project = upstream_dir.split("/")[-1]
-        update_upstream(project, rollout=rollout)
+    with os.scandir("upstream") as entries:
+        projects = [f.name for f in entries if f.is_dir()]
+    # each project has its own compose setup, so their (network bound) pulls and restarts can overlap
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # consume the results so exceptions from the workers are raised here
+        list(executor.map(lambda project: update_upstream(project, rollout=rollout), projects))
 
 
 def rollout_service(project: str, service: str) -> None:
@@ -9,12 +9,20 @@ from lib.models import Env, Project
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.data import Service
-from lib.upstream import update_upstream, update_upstreams, write_upstream
+from lib.upstream import (
+    _ENV,
+    update_upstream,
+    update_upstreams,
+    write_upstream,
+    write_upstream_volume_folders,
+    write_upstreams,
+)
 
 
 class DirEntry:
     def __init__(self, path: str):
         self.path = path
+        self.name = os.path.basename(path)
 
     def is_dir(self) -> bool:
         return True
@@ -81,11 +89,16 @@ _ret_projects = [
 
 
 class TestUpdateUpstream(TestCase):
+    @mock.patch("os.makedirs")
     @mock.patch("builtins.open", new_callable=mock.mock_open, read_data=_ret_tpl)
     def test_write_upstream(
         self,
         mock_open: Mock,
+        mock_makedirs: Mock,
     ) -> None:
+        # make sure the template is loaded through the mocked open, and doesn't stay cached for other tests
+        _ENV.cache.clear()
+        self.addCleanup(_ENV.cache.clear)
 
         project = Project(
             name="test",
@@ -105,7 +118,9 @@ class TestUpdateUpstream(TestCase):
         write_upstream(project)
 
         # Assert that the subprocess.Popen was called with the correct arguments
-        mock_open.return_value.write.assert_called_once_with(_ret_tpl)
+        mock_makedirs.assert_called_once_with("upstream/test", exist_ok=True)
+        mock_open.return_value.writelines.assert_called_once()
+        self.assertEqual("".join(mock_open.return_value.writelines.call_args.args[0]), _ret_tpl)
 
     @mock.patch("lib.upstream.rollout_service")
     @mock.patch("lib.upstream.run_command")
@@ -203,7 +218,7 @@ class TestUpdateUpstream(TestCase):
     @mock.patch("lib.upstream.run_command")
     @mock.patch("lib.upstream.get_project", return_value=_ret_projects[0])
     def test_update_upstreams(self, _: Mock, _2: Mock, mock_update_upstream: Mock, mock_scandir: Mock) -> None:
-        mock_scandir.return_value = [DirEntry("upstream/my-project")]
+        mock_scandir.return_value.__enter__.return_value = [DirEntry("upstream/my-project")]
 
         # Call the function under test
         update_upstreams()
@@ -214,5 +229,58 @@ class TestUpdateUpstream(TestCase):
         )
 
 
+class TestWriteUpstreams(TestCase):
+    @mock.patch("lib.upstream.write_upstream_volume_folders")
+    @mock.patch("lib.upstream.write_upstream")
+    @mock.patch("lib.upstream.get_projects", return_value=_ret_projects)
+    def test_write_upstreams(
+        self,
+        _: Mock,
+        mock_write_upstream: Mock,
+        mock_write_upstream_volume_folders: Mock,
+    ) -> None:
+
+        # Call the function under test
+        write_upstreams()
+
+        # Assert that every project got its files and folders written exactly once
+        self.assertCountEqual(mock_write_upstream.call_args_list, [call(p) for p in _ret_projects])
+        self.assertCountEqual(mock_write_upstream_volume_folders.call_args_list, [call(p) for p in _ret_projects])
+
+    @mock.patch("lib.upstream.write_upstream")
+    @mock.patch("lib.upstream.get_projects", return_value=[])
+    def test_write_upstreams_no_projects(self, _: Mock, mock_write_upstream: Mock) -> None:
+
+        # Call the function under test
+        write_upstreams()
+
+        mock_write_upstream.assert_not_called()
+
+
+class TestWriteUpstreamVolumeFolders(TestCase):
+    @mock.patch("os.makedirs")
+    def test_write_upstream_volume_folders(self, mock_makedirs: Mock) -> None:
+        project = Project(
+            name="my-project",
+            services=[
+                Service(host="s1", volumes=["./data:/data", "./data/bla:/data/bla:ro", "/etc/host:/etc/host"]),
+                Service(host="s2", volumes=["./data/bla:/data/bla", "./data-x:/data-x", "/var/lib"]),
+            ],
+        )
+
+        # Call the function under test
+        write_upstream_volume_folders(project)
+
+        # Assert that only the deepest folders get created, and only once
+        self.assertCountEqual(
+            mock_makedirs.call_args_list,
+            [
+                call("upstream/my-project/data/bla", exist_ok=True),
+                call("upstream/my-project/data-x", exist_ok=True),
+                call("upstream/my-project/var/lib", exist_ok=True),
+            ],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
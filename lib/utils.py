@@ -1,18 +1,58 @@
 import os
 import subprocess
-from typing import Dict, List
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterator, List
+
+
+@lru_cache(maxsize=64)
+def _read_env_file(file: str, mtime_ns: int, size: int) -> Dict[str, str]:
+    env = {}
+    with open(file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#"):
+                continue
+            key, sep, value = line.partition("=")
+            if sep:
+                env[key] = value
+    return env
 
 
 # func that reads .env file into a dictionary
 def read_env_file(file: str) -> Dict[str, str]:
-    with open(file, "r", encoding="utf-8") as f:
-        return dict(line.strip().split("=", 1) for line in f if not line.strip().startswith("#") and "=" in line)
+    # only parse the file again when it changed, and hand out a copy so callers can't change the cached one
+    stat = os.stat(file)
+    return dict(_read_env_file(file, stat.st_mtime_ns, stat.st_size))
+
+
+def _command_env(cwd: str = None) -> Dict[str, str] | None:
+    if not cwd:
+        # nothing to add, so let the command inherit our env
+        return None
+    # a missing .env just means no extra env
+    try:
+        env = read_env_file(f"{cwd}/.env")
+    except FileNotFoundError:
+        return None
+    # add to our env instead of replacing it, so the command still has PATH, HOME etc.
+    return {**os.environ, **env}
+
+
+@contextmanager
+def _open_log() -> Iterator[int]:
+    # append, as commands may run concurrently and would otherwise clobber each other's output
+    # (a raw fd is all the commands need, so skip building a python file object around it)
+    fd = os.open("logs/error.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
 
 
 def run_command(command: List[str], cwd: str = None) -> int:
-    env_file = f"{cwd}/.env" if cwd else ""
-    env = read_env_file(env_file) if env_file != "" and os.path.exists(env_file) else {}
-    with open("logs/error.log", "w", encoding="utf-8") as f:
+    env = _command_env(cwd)
+    with _open_log() as f:
         process = subprocess.run(
             command,
             check=True,
@@ -22,3 +62,25 @@ def run_command(command: List[str], cwd: str = None) -> int:
             stderr=f,
         )
     return process.returncode
+
+
+def start_command(command: List[str], cwd: str = None) -> subprocess.Popen[bytes]:
+    """Start a command in the background (logging to the same file as run_command). Caller must wait() on it."""
+    env = _command_env(cwd)
+    with _open_log() as f:
+        return subprocess.Popen(
+            command,
+            cwd=cwd,
+            env=env,
+            stdout=f,
+            stderr=f,
+        )
+
+
+def wait_commands(processes: List[subprocess.Popen[bytes]]) -> None:
+    """Wait for all processes started with start_command, raising for the first one that failed"""
+    for process in processes:
+        process.wait()
+    for process in processes:
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
@@ -1,4 +1,5 @@
 import os
+import subprocess
 import sys
 import unittest
 from unittest import mock
@@ -6,15 +7,22 @@ from unittest.mock import Mock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from lib.utils import run_command
+from lib.utils import (
+    _read_env_file,
+    read_env_file,
+    run_command,
+    start_command,
+    wait_commands,
+)
 
 
 class TestRunCommand(unittest.TestCase):
 
     # Runs command with no errors and returns exit code
-    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("os.close")
+    @mock.patch("os.open", return_value=3)
     @mock.patch("subprocess.run")
-    def test_runs_command_no_errors(self, mock_run: Mock, mock_open: Mock) -> None:
+    def test_runs_command_no_errors(self, mock_run: Mock, mock_open: Mock, mock_close: Mock) -> None:
 
         # Set up mock
         mock_process = mock_run.return_value
@@ -25,12 +33,89 @@ class TestRunCommand(unittest.TestCase):
 
         # Assert the exit code is returned correctly
         self.assertEqual(exit_code, 0)
-        # Assert the open call was made correctly
-        mock_open.assert_called_with("logs/error.log", "w", encoding="utf-8")
+        # Assert the log is opened for appending, and closed again
+        mock_open.assert_called_once_with("logs/error.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        mock_close.assert_called_once_with(3)
         # Assert the subprocess.run call was made correctly
-        mock_run.assert_called_once_with(
-            ["ls"], check=True, cwd=None, env={}, stdout=mock_open.return_value, stderr=mock_open.return_value
-        )
+        mock_run.assert_called_once_with(["ls"], check=True, cwd=None, env=None, stdout=3, stderr=3)
+
+    # Runs command with the .env from its cwd added to the inherited env
+    @mock.patch.dict("os.environ", {"PATH": "/usr/bin", "TARGET": "world"}, clear=True)
+    @mock.patch("lib.utils.read_env_file", return_value={"TARGET": "boss"})
+    @mock.patch("os.close")
+    @mock.patch("os.open", return_value=3)
+    @mock.patch("subprocess.run")
+    def test_runs_command_with_env_file(self, mock_run: Mock, _: Mock, _2: Mock, mock_read_env_file: Mock) -> None:
+
+        # Call the function under test
+        run_command(["docker", "compose", "up", "-d"], cwd="upstream/test")
+
+        mock_read_env_file.assert_called_once_with("upstream/test/.env")
+        self.assertEqual(mock_run.call_args.kwargs["env"], {"PATH": "/usr/bin", "TARGET": "boss"})
+
+    # Runs command with the inherited env when its cwd has no .env
+    @mock.patch("lib.utils.read_env_file", side_effect=FileNotFoundError)
+    @mock.patch("os.close")
+    @mock.patch("os.open", return_value=3)
+    @mock.patch("subprocess.run")
+    def test_runs_command_without_env_file(self, mock_run: Mock, _: Mock, _2: Mock, _3: Mock) -> None:
+
+        # Call the function under test
+        run_command(["docker", "compose", "up", "-d"], cwd="upstream/test")
+
+        self.assertIsNone(mock_run.call_args.kwargs["env"])
+
+    # Starts command in the background and hands back the process
+    @mock.patch("os.close")
+    @mock.patch("os.open", return_value=3)
+    @mock.patch("subprocess.Popen")
+    def test_start_command(self, mock_popen: Mock, mock_open: Mock, mock_close: Mock) -> None:
+
+        # Call the function under test
+        process = start_command(["docker", "compose", "pull"])
+
+        # Assert the process is returned without waiting on it
+        self.assertEqual(process, mock_popen.return_value)
+        mock_popen.return_value.wait.assert_not_called()
+        # Assert the log is appended to instead of truncated, and our fd is closed once the child has it
+        mock_open.assert_called_once_with("logs/error.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        mock_close.assert_called_once_with(3)
+        mock_popen.assert_called_once_with(["docker", "compose", "pull"], cwd=None, env=None, stdout=3, stderr=3)
+
+    # Reads a .env file only again when it changed
+    @mock.patch("os.stat")
+    @mock.patch("builtins.open", new_callable=mock.mock_open, read_data="# comment\nA=1\nB=x=y\n")
+    def test_read_env_file_cached(self, mock_open: Mock, mock_stat: Mock) -> None:
+        _read_env_file.cache_clear()
+        self.addCleanup(_read_env_file.cache_clear)
+        mock_stat.return_value = Mock(st_mtime_ns=1, st_size=14)
+
+        # Call the function under test
+        env = read_env_file("upstream/test/.env")
+        env["A"] = "changed"
+
+        # Assert that the unchanged file is parsed only once, and callers get their own copy
+        self.assertEqual(read_env_file("upstream/test/.env"), {"A": "1", "B": "x=y"})
+        mock_open.assert_called_once_with("upstream/test/.env", "r", encoding="utf-8")
+
+        # Assert that a changed file is parsed again
+        mock_stat.return_value = Mock(st_mtime_ns=2, st_size=14)
+        read_env_file("upstream/test/.env")
+        self.assertEqual(mock_open.call_count, 2)
+
+    # Waits for all processes before raising for a failed one
+    def test_wait_commands_raises_after_waiting_all(self) -> None:
+
+        failed = Mock(returncode=1, args=["docker", "rollout", "proxy"])
+        succeeded = Mock(returncode=0, args=["docker", "rollout", "terminate"])
+
+        # Call the function under test
+        with self.assertRaises(subprocess.CalledProcessError):
+            wait_commands([failed, succeeded])
+
+        # Assert both processes were waited on
+        failed.wait.assert_called_once()
+        succeeded.wait.assert_called_once()
 
 
 if __name__ == "__main__":